@@ -38,7 +38,8 @@ def get_pdf_metadata():
     :return: A dataframe with the pdfs and their metadata.
     """
     with engine.connect() as conn:
-        query1 = "SELECT * FROM pdfs;"
+        query1 = ("SELECT pdfId, pdfName, pdfSize, filingId, date, totalPages, company, submitter, application_id, "
+                  "status FROM pdfs;")
         df = pd.read_sql(query1, conn)
     return df
         
@@ -2,25 +2,63 @@ import re
 import PyPDF2
 from pathlib import Path
 from dotenv import load_dotenv
-from sqlalchemy import text, create_engine
-from multiprocessing import Pool
+from sqlalchemy import text, create_engine, bindparam
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+from collections import deque
+from itertools import count
 import os
 import pandas as pd
 import time
 from tika import parser
 from wand.image import Image
-from io import StringIO
+import fitz
+from io import StringIO, BytesIO
 from contextlib import redirect_stdout, redirect_stderr
 import camelot
 from uuid import uuid4
 import traceback
 import json
+import pickle
+import hashlib
+import gzip
+import zlib
+import base64
 import numpy as np
+from functools import lru_cache
+import socket
+import threading
+import shutil
 
 pdfs_and_projects_file = Path("pdfs_table.csv")
+pdfs_and_projects_cache = Path("pdfs_table.pickle")
 pdf_files_folder = Path("//luxor/data/board/Dev/PCMR/pdf_files")
-csv_tables_folder = Path("//luxor/data/board/Dev/PCMR/csv_tables")
+csv_tables_folder = Path("//luxor/data/board/Dev/PCMR/csv_tables")  # See ArtifactStore for the layout of these two
 jpg_tables_folder = Path("//luxor/data/board/Dev/PCMR/jpg_tables")
+manual_csvs_folder = Path("//luxor/data/board/Dev/PCMR/manual_csv")
+xml_content_folder = Path("//luxor/data/board/Dev/PCMR/xml_content")
+# "inline", "zlib" (compressed in pdfs.xmlContent) or "blob" (in xml_content_folder). Only switch away from inline
+# once every reader of pdfs.xmlContent goes through decode_xml_content, then run migrate_xml_contents.
+xml_content_storage = "inline"
+tika_cache_folder = Path("tika_cache")
+pdf_cache_folder = Path(os.getenv("PDF_CACHE_DIR", "pdf_cache"))  # Preferably on a local SSD
+pdf_cache_size = int(os.getenv("PDF_CACHE_SIZE_GB", 50)) * 1024 * 1024 * 1024
+fetch_lock_timeout = 1800  # Seconds after which the lock of a pdf_cache fetch is considered left by a crashed worker
+render_cache_folder = Path(os.getenv("RENDER_CACHE_DIR", "render_cache"))
+render_cache_size = int(os.getenv("RENDER_CACHE_SIZE_GB", 20)) * 1024 * 1024 * 1024
+tika_endpoints = [f"http://localhost:{port}" for port in range(9998, 9998 + 4)]
+extraction_timeout = 600  # Seconds a single page may take in extract_csvs/extract_images before it is quarantined
+max_tasks_per_child = 25  # Extraction workers are recycled after this many pages
+write_batch_size = 500  # Rows of the coordinate and status updates the parent sends to the DB in one executemany
+render_memory_budget = int(os.getenv("RENDER_MEMORY_BUDGET_MB", 8192)) * 1024 * 1024  # For all concurrent renders
+image_renderer = "wand"  # Default backend of extract_images, see page_renderers
+crop_pixel_budget = 4_000_000  # Target pixels of a table image, the resolution is derived from the table's extent
+crop_min_resolution = 100  # DPI bounds of table images, large drawings exceed the budget rather than going below
+crop_max_resolution = 600
+page_max_resolution = 300  # Full page renders of the wand renderer, only the pymupdf clips go above it
+page_pixel_budget = 80_000_000  # Cap of the full page renders of the wand renderer (~300 DPI on a 36"x24" drawing)
+image_levels = {"thumb": 256, "medium": 1024}  # Downscaled copies (longest side in pixels) in jpg_tables subfolders
+image_levels_format = "jpg"  # Or "webp". The full image stays <tableId>.jpg, which the apps link to.
 
 if not pdf_files_folder.exists():
     raise Exception(f"{pdf_files_folder} does not exist!")
@@ -38,6 +76,476 @@ engine_string = f"mysql+mysqldb://{user}:{password}@{host}/{database}?charset=ut
 engine = create_engine(engine_string)
 engine2_string = f"mssql+pyodbc://psql23cap/Regulatory_Untrusted?driver=SQL+Server+Native+Client+11.0"
 engine2 = create_engine(engine2_string)
+worker_engine = None
+
+
+# Pool initializer: builds one pooled engine per worker process that is reused by every task the worker runs
+def init_worker(engine_string_):
+    global worker_engine
+    worker_engine = create_engine(engine_string_, pool_size=1, pool_pre_ping=True, pool_recycle=3600)
+
+
+# Collects the parameter rows of one statement and runs them as a single executemany once batch_size rows are
+# pending, and on exit. Used in the parent, so that the workers do not write every status flag on their own.
+class BatchedWriter:
+    def __init__(self, statement, batch_size=write_batch_size):
+        self.statement = text(statement)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+    def add(self, rows):
+        self.rows.extend(rows)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        with engine.connect() as conn:
+            conn.execute(self.statement, self.rows)
+        self.rows = []
+
+
+# Size-bounded local copy of files read from the network share. A copy is keyed by the source's path, mtime and
+# size, so a changed file is fetched again. The modification time of a copy is bumped on every hit and is what the
+# least recently used eviction goes by. The cache folder is shared by all the worker processes.
+class LocalFileCache:
+    def __init__(self, folder, max_size):
+        self.folder = folder
+        self.max_size = max_size
+
+    def cache_path(self, path):
+        path = Path(path)
+        stat = path.stat()
+        key = hashlib.sha1(f"{path.resolve()}|{stat.st_mtime_ns}|{stat.st_size}".encode("utf-8")).hexdigest()
+        return self.folder.joinpath(f"{key}{path.suffix}")
+
+    # Only one process or thread fetches a file at a time, holding <key>.lock, the others wait for its copy. A lock
+    # older than fetch_lock_timeout is left by a crashed worker and is taken over.
+    def get(self, path):
+        cached = self.cache_path(path)
+        lock = cached.with_name(f"{cached.name}.lock")
+        while not cached.exists():
+            self.folder.mkdir(parents=True, exist_ok=True)
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                try:
+                    if time.time() - lock.stat().st_mtime > fetch_lock_timeout:
+                        lock.unlink(missing_ok=True)
+                except FileNotFoundError:
+                    pass
+                time.sleep(0.2)
+                continue
+            try:
+                if not cached.exists():  # Fetched by the previous holder of the lock
+                    tmp = cached.with_name(f"{cached.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                    shutil.copyfile(path, tmp)
+                    try:
+                        os.replace(tmp, cached)
+                    except PermissionError:  # Already there and open in another worker on Windows
+                        tmp.unlink(missing_ok=True)
+                        if not cached.exists():
+                            raise
+            finally:
+                lock.unlink(missing_ok=True)
+            self.evict()
+            return cached
+        os.utime(cached)
+        return cached
+
+    def evict(self):
+        files = []
+        for f in self.folder.glob("*"):
+            if f.suffix in (".tmp", ".lock"):
+                continue
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, f))
+        total = sum(size for _, size, _ in files)
+        for _, size, f in sorted(files):
+            if total <= self.max_size:
+                break
+            try:
+                f.unlink()
+                total -= size
+            except (FileNotFoundError, PermissionError):  # Removed by another worker or still open on Windows
+                pass
+
+    # Copies the files the upcoming tasks will need in a background thread, in the given order, stopping once
+    # half of the cache is taken by the prefetched files so that they do not evict each other before being used
+    def prefetch(self, paths):
+        def fetch():
+            fetched = 0
+            for path in paths:
+                try:
+                    fetched += self.get(path).stat().st_size
+                except Exception as e:
+                    print(f"Could not prefetch {path}: {e}")
+                if fetched > self.max_size / 2:
+                    break
+
+        thread = threading.Thread(target=fetch, daemon=True)
+        thread.start()
+        return thread
+
+
+pdf_cache = LocalFileCache(pdf_cache_folder, pdf_cache_size)
+
+
+# Rendered pages stored as PNGs, keyed by the SHA-256 of the PDF, the page and the resolution. Shares the size bound
+# and the least recently used eviction of LocalFileCache.
+class RenderCache(LocalFileCache):
+    def page_path(self, pdf_sha256, page, resolution):
+        return self.folder.joinpath(f"{pdf_sha256}_{page}_{resolution}.png")
+
+    def load(self, pdf_sha256, page, resolution):
+        cached = self.page_path(pdf_sha256, page, resolution)
+        if not cached.exists():
+            return None
+        os.utime(cached)
+        return Image(filename=str(cached))
+
+    def store(self, img, pdf_sha256, page, resolution):
+        cached = self.page_path(pdf_sha256, page, resolution)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+        with img.clone() as png:
+            png.format = "png"
+            png.save(filename=str(tmp))
+        os.replace(tmp, cached)
+        self.evict()
+
+
+render_cache = RenderCache(render_cache_folder, render_cache_size)
+
+
+# Page renderers of extract_image. They crop tables given in the pdfX1..pdfY2 coordinates that populate_coordinates
+# computed against pdfWidth x pdfHeight (origin at the bottom left) and return each crop as a wand Image.
+# WandPageRenderer renders the whole page through ImageMagick/Ghostscript once (via render_cache) and crops from it.
+# The page is rendered at page_max_resolution (lower for pages over page_pixel_budget), which only depends on the page
+# so that render_cache keeps hitting, and each crop is then scaled down to its own resolution.
+class WandPageRenderer:
+    def __init__(self, pdf_path, page, resolution):
+        self.img = render_page(pdf_path, page, resolution)
+        self.resolution = resolution
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.img.close()
+
+    def crop(self, table, resolution):
+        left = round(table["pdfX1"] * self.img.width / table["pdfWidth"])
+        top = round((table["pdfHeight"] - table["pdfY1"]) * self.img.height / table["pdfHeight"])
+        right = round(table["pdfX2"] * self.img.width / table["pdfWidth"])
+        bottom = round((table["pdfHeight"] - table["pdfY2"]) * self.img.height / table["pdfHeight"])
+        crop = self.img.clone()
+        crop.crop(left=left, top=top, right=right, bottom=bottom)
+        if resolution < self.resolution:
+            crop.resize(max(round(crop.width * resolution / self.resolution), 1),
+                        max(round(crop.height * resolution / self.resolution), 1))
+        return crop
+
+
+# PyMuPdfPageRenderer renders only the table's rectangle, directly at the needed resolution, without Ghostscript
+class PyMuPdfPageRenderer:
+    def __init__(self, pdf_path, page, resolution):
+        self.doc = fitz.open(str(pdf_path))
+        self.page = self.doc.load_page(page - 1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.doc.close()
+
+    def crop(self, table, resolution):
+        x_scale = self.page.rect.width / table["pdfWidth"]
+        y_scale = self.page.rect.height / table["pdfHeight"]
+        clip = fitz.Rect(table["pdfX1"] * x_scale, (table["pdfHeight"] - table["pdfY1"]) * y_scale,
+                         table["pdfX2"] * x_scale, (table["pdfHeight"] - table["pdfY2"]) * y_scale)
+        zoom = resolution / 72
+        pix = self.page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), clip=clip.normalize(), alpha=False)
+        return Image(blob=pix.tobytes("png"))
+
+
+page_renderers = {"wand": WandPageRenderer, "pymupdf": PyMuPdfPageRenderer}
+
+
+@lru_cache(maxsize=64)
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# Returns the rendered page (1-based) as a wand Image, from render_cache if this page was rendered before at the
+# same resolution. pdf_path should be a local copy from pdf_cache, its path is what the hash is memoized by.
+def render_page(pdf_path, page, resolution=300):
+    pdf_sha256 = file_sha256(str(pdf_path))
+    img = render_cache.load(pdf_sha256, page, resolution)
+    if img is None:
+        img = Image(filename=f"{Path(pdf_path).resolve()}[{page - 1}]", resolution=resolution)
+        render_cache.store(img, pdf_sha256, page, resolution)
+    return img
+
+
+# CSVs and JPGs are stored in csv_tables/jpg_tables under a shard folder named after the first two characters of their
+# owner's id (csvId or tableId), e.g. jpg_tables/3f/<tableId>.jpg or jpg_tables/thumb/3f/<tableId>.jpg, and every file
+# is recorded in the artifacts table with its hash and size. Cleanups diff that index against the DB instead of
+# listing the share. server.js maps the unsharded /csv and /jpg URLs onto the shards.
+# The rows are inserted before the files are written, so that no file is left out of the index by a worker that is
+# killed or fails half way; a row whose file was never written is dropped like any other unreferenced one.
+class ArtifactStore:
+    def __init__(self, kind, folder):
+        self.kind = kind
+        self.folder = Path(folder)
+        self.created = set()
+
+    @staticmethod
+    def relative_path(owner_id, name, level=None):
+        return f"{level}/{owner_id[:2]}/{name}" if level else f"{owner_id[:2]}/{name}"
+
+    # Returns a (artifacts_statement parameters, data) file for put
+    def file(self, owner_id, name, data, level=None):
+        row = {"path": self.relative_path(owner_id, name, level), "kind": self.kind, "ownerId": owner_id,
+               "sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+        return row, data
+
+    def target(self, relative_path):
+        path = self.folder.joinpath(relative_path)
+        if path.parent not in self.created:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self.created.add(path.parent)
+        return path
+
+    # Indexes the files and then writes them
+    def put(self, files, engine_=None):
+        if not files:
+            return
+        with (engine_ or engine).connect() as conn:
+            conn.execute(text(artifacts_statement), [row for row, _ in files])
+        for row, data in files:
+            self.target(row["path"]).write_bytes(data)
+
+    def delete(self, relative_paths):
+        for relative_path in relative_paths:
+            self.folder.joinpath(relative_path).unlink(missing_ok=True)
+
+
+artifacts_statement = ("REPLACE INTO artifacts (path, kind, ownerId, sha256, size) "
+                       "VALUE (:path, :kind, :ownerId, :sha256, :size);")
+
+
+def create_artifacts_table():
+    with engine.connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS artifacts (path varchar(255) NOT NULL, kind varchar(8) NOT NULL, "
+                     "ownerId varchar(36) NOT NULL, sha256 char(64) NOT NULL, size int NOT NULL, "
+                     "PRIMARY KEY (kind, path), KEY owner_idx (kind, ownerId));")
+
+
+def supervised_worker(conn, func, initializer, initargs, max_tasks):
+    if initializer is not None:
+        initializer(*initargs)
+    tasks = 0
+    while max_tasks is None or tasks < max_tasks:
+        try:
+            arg = conn.recv()
+        except EOFError:
+            break
+        if arg is None:
+            break
+        try:
+            result = func(arg)
+        except Exception as e:
+            result = (True, f"ERROR! {e}\n")
+        conn.send(result)
+        tasks += 1
+    conn.close()
+
+
+# A process pool that knows which task every worker is running. Tasks that run longer than timeout seconds get
+# their worker terminated (and replaced), workers that crash are replaced, and every worker is recycled after
+# max_tasks_per_child tasks to give back the memory that ImageMagick/Ghostscript accumulate.
+# With a memory_budget, tasks are only admitted while the estimated memory (cost) of the running tasks fits into
+# it, and idle workers are stopped while the budget is the limit, so concurrency follows the size of the work.
+# poll() returns the (key, result, timed_out) of the tasks that completed since the previous call.
+class SupervisedPool:
+    def __init__(self, func, processes=None, timeout=None, max_tasks_per_child=None, initializer=None, initargs=(),
+                 memory_budget=None):
+        self.func = func
+        self.processes = processes or os.cpu_count()
+        self.timeout = timeout
+        self.max_tasks_per_child = max_tasks_per_child
+        self.initializer = initializer
+        self.initargs = initargs
+        self.memory_budget = memory_budget
+        self.queue = deque()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def submit(self, key, arg, cost=0):
+        self.queue.append((key, arg, cost))
+
+    def unfinished(self):
+        return len(self.queue) + sum(worker["key"] is not None for worker in self.workers)
+
+    def start_worker(self):
+        conn, child_conn = Pipe()
+        process = Process(target=supervised_worker, daemon=True,
+                          args=(child_conn, self.func, self.initializer, self.initargs, self.max_tasks_per_child))
+        process.start()
+        child_conn.close()
+        worker = {"process": process, "conn": conn, "key": None, "started": None, "tasks": 0, "cost": 0}
+        self.workers.append(worker)
+        return worker
+
+    def stop_worker(self, worker, terminate=False):
+        if terminate:
+            worker["process"].terminate()
+        worker["process"].join()
+        worker["conn"].close()
+        self.workers.remove(worker)
+
+    # Returns the index of the first queued task that fits into the memory budget. A task bigger than the whole
+    # budget is still run once nothing else is running.
+    def next_task(self):
+        if self.memory_budget is None:
+            return 0
+        running = [worker["cost"] for worker in self.workers if worker["key"] is not None]
+        if not running:
+            return 0
+        for i, (_, _, cost) in enumerate(self.queue):
+            if sum(running) + cost <= self.memory_budget:
+                return i
+        return None
+
+    def dispatch(self):
+        idle = [worker for worker in self.workers if worker["key"] is None]
+        while self.queue:
+            if not idle and len(self.workers) >= self.processes:
+                break
+            i = self.next_task()
+            if i is None:
+                # Memory is the limit, so the idle workers only hold on to what their previous renders allocated
+                for worker in idle:
+                    worker["conn"].send(None)
+                    self.stop_worker(worker)
+                break
+            worker = idle.pop() if idle else self.start_worker()
+            key, arg, cost = self.queue[i]
+            del self.queue[i]
+            worker["conn"].send(arg)
+            worker["key"] = key
+            worker["cost"] = cost
+            worker["started"] = time.time()
+
+    def poll(self, wait_seconds=1.0):
+        self.dispatch()
+        completed = []
+        busy = {worker["conn"]: worker for worker in self.workers if worker["key"] is not None}
+        for conn in wait(list(busy), timeout=wait_seconds):
+            worker = busy[conn]
+            key = worker["key"]
+            try:
+                result = conn.recv()
+            except (EOFError, OSError):
+                worker["process"].join()
+                completed.append((key, (True, f"{key}: worker died with exit code {worker['process'].exitcode}\n"),
+                                  False))
+                self.stop_worker(worker)
+                continue
+            completed.append((key, result, False))
+            worker["key"] = None
+            worker["tasks"] += 1
+            if self.max_tasks_per_child is not None and worker["tasks"] >= self.max_tasks_per_child:
+                self.stop_worker(worker)
+
+        if self.timeout is not None:
+            now = time.time()
+            for worker in list(self.workers):
+                if worker["key"] is not None and now - worker["started"] > self.timeout:
+                    completed.append((worker["key"], (True, f"{worker['key']}: timed out after {self.timeout} "
+                                                            f"seconds, the worker was terminated\n"), True))
+                    self.stop_worker(worker, terminate=True)
+        self.dispatch()
+        return completed
+
+    def close(self):
+        for worker in list(self.workers):
+            busy = worker["key"] is not None
+            if not busy:
+                worker["conn"].send(None)
+            self.stop_worker(worker, terminate=busy)
+
+
+# Runs func over args in a SupervisedPool. Every task returns a (failed, output) tuple. In streaming mode the output
+# of each task is printed as soon as it completes, together with a periodic throughput/ETA line, so that nothing
+# is buffered in the parent. Buffered mode (stream=False) waits for all the tasks and prints the outputs in order.
+# Returns the args of the failed tasks and the args of the tasks that timed out (which are among the failed ones).
+# costs (estimated bytes per task) are only used together with memory_budget, see SupervisedPool.
+# Tasks may return a list of parameter rows as a third element, which are added to writer (a BatchedWriter).
+def run_pool(func, args, stream=True, progress_interval=10, timeout=None, max_tasks_per_child=None, costs=None,
+             memory_budget=None, writer=None):
+    total = len(args)
+    failures = []
+    timed_out = []
+    outputs = {}
+    start_time = time.time()
+    last_progress = start_time
+
+    def print_progress(done_):
+        elapsed = time.time() - start_time
+        rate = done_ / elapsed if elapsed else 0
+        eta = round((total - done_) / rate / 60, 2) if rate else "?"
+        print(f"Progress: {done_}/{total} done, {len(failures)} failed ({len(timed_out)} timed out), "
+              f"{round(rate * 60, 1)} per min, ETA {eta} min", flush=True)
+
+    with SupervisedPool(func, timeout=timeout, max_tasks_per_child=max_tasks_per_child,
+                        initializer=init_worker, initargs=(engine_string,), memory_budget=memory_budget) as pool:
+        for i, arg in enumerate(args):
+            pool.submit(i, arg, costs[i] if costs else 0)
+
+        done = 0
+        while pool.unfinished():
+            for i, (failed, output, *rows), timed_out_ in pool.poll():
+                done += 1
+                if writer is not None and rows:
+                    writer.add(rows[0])
+                if failed:
+                    failures.append(args[i])
+                if timed_out_:
+                    timed_out.append(args[i])
+                if not stream:
+                    outputs[i] = output
+                    continue
+                print(output, end='', flush=True)
+                if time.time() - last_progress >= progress_interval or done == total:
+                    last_progress = time.time()
+                    print_progress(done)
+
+    if not stream:
+        for i in range(total):
+            print(outputs[i], end='', flush=True)
+        print_progress(total)
+    return failures, timed_out
 
 
 ############################################################################
@@ -45,50 +553,140 @@ engine2 = create_engine(engine2_string)
 ############################################################################
 
 
+# Extracts XHTML with a fixed set of long-lived local Tika servers (tika-python starts a server for a localhost
+# endpoint on first use and keeps it running). Results are cached on disk by the SHA-256 of the PDF, so re-runs and
+# duplicate reports filed under a different name do not go through Tika again.
+class TikaExtractor:
+    def __init__(self, endpoints, cache_folder):
+        self.endpoints = endpoints
+        self.cache_folder = cache_folder
+        self.calls = os.getpid()  # Spreads the workers of a Pool across the servers
+
+    def cache_path(self, sha256):
+        return self.cache_folder.joinpath(sha256[:2], f"{sha256}.xhtml.gz")
+
+    def start_servers(self):
+        for endpoint in self.endpoints:
+            parser.from_buffer("", serverEndpoint=endpoint)
+
+    def extract(self, pdf_bytes, sha256=None):
+        sha256 = sha256 or hashlib.sha256(pdf_bytes).hexdigest()
+        cached = self.cache_path(sha256)
+        if cached.exists():
+            return gzip.decompress(cached.read_bytes()).decode("utf-8")
+
+        endpoint = self.endpoints[self.calls % len(self.endpoints)]
+        self.calls += 1
+        content = parser.from_buffer(pdf_bytes, serverEndpoint=endpoint, xmlContent=True)["content"]
+        if content is not None:
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            tmp = cached.with_name(f"{cached.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(gzip.compress(content.encode("utf-8")))
+            os.replace(tmp, cached)
+        return content
+
+
+tika_extractor = TikaExtractor(tika_endpoints, tika_cache_folder)
+
+
+# Converts Tika's XHTML into the value stored in pdfs.xmlContent according to xml_content_storage. Compressed
+# values are prefixed with "zlib:" and externalized ones are stored as "blob:<SHA-256 of the XHTML>".
+def encode_xml_content(content):
+    if content is None or xml_content_storage == "inline":
+        return content
+    content_bytes = content.encode("utf-8")
+    if xml_content_storage == "zlib":
+        return "zlib:" + base64.b64encode(zlib.compress(content_bytes, 9)).decode("ascii")
+    if xml_content_storage == "blob":
+        sha256 = hashlib.sha256(content_bytes).hexdigest()
+        blob = xml_content_folder.joinpath(sha256[:2], f"{sha256}.xhtml.gz")
+        if not blob.exists():
+            blob.parent.mkdir(parents=True, exist_ok=True)
+            tmp = blob.with_name(f"{blob.name}.{os.getpid()}.tmp")
+            tmp.write_bytes(gzip.compress(content_bytes))
+            os.replace(tmp, blob)
+        return f"blob:{sha256}"
+    raise Exception(f"Unknown xml_content_storage: {xml_content_storage}")
+
+
+# Transparent reader for pdfs.xmlContent values written in any of the storage modes
+def decode_xml_content(value):
+    if value is None:
+        return None
+    if value.startswith("zlib:"):
+        return zlib.decompress(base64.b64decode(value[5:])).decode("utf-8")
+    if value.startswith("blob:"):
+        sha256 = value[5:]
+        blob = xml_content_folder.joinpath(sha256[:2], f"{sha256}.xhtml.gz")
+        return gzip.decompress(blob.read_bytes()).decode("utf-8")
+    return value
+
+
+def read_xml_content(pdf_name):
+    with engine.connect() as conn:
+        stmt = text("SELECT xmlContent FROM pdfs WHERE pdfName = :pdf_name;")
+        row = conn.execute(stmt, {"pdf_name": pdf_name}).fetchone()
+    if row is None:
+        raise Exception(f"{pdf_name} is not found in the DB")
+    return decode_xml_content(row[0])
+
+
+# Re-encodes the xmlContent of the PDFs that were inserted with inline storage into the current xml_content_storage
+def migrate_xml_contents():
+    if xml_content_storage == "inline":
+        return print("xml_content_storage is inline, nothing to migrate")
+    with engine.connect() as conn:
+        stmt = "SELECT pdfName FROM pdfs WHERE xmlContent NOT LIKE 'zlib:%%' AND xmlContent NOT LIKE 'blob:%%';"
+        pdf_names = [row[0] for row in conn.execute(stmt)]
+    print(f"Migrating xmlContent of {len(pdf_names)} PDFs to {xml_content_storage} storage")
+    for pdf_name in pdf_names:
+        content = read_xml_content(pdf_name)
+        with engine.connect() as conn:
+            stmt = text("UPDATE pdfs SET xmlContent = :xmlContent WHERE pdfName = :pdf_name;")
+            conn.execute(stmt, {"xmlContent": encode_xml_content(content), "pdf_name": pdf_name})
+    print(f"Migrated {len(pdf_names)} PDFs")
+
+
+def get_pdfs_metadata(pdf_names, chunk_size=500):
+    # SQL Server allows at most 2100 parameters per statement, so names are looked up in chunks
+    # noinspection SqlResolve
+    def get_chunk_metadata(names):
+        values = ", ".join(f"(:name{i})" for i in range(len(names)))
+        stmt = text(f"SELECT n.pdfName, d.ParentID, d.DataID, d.CreateDate FROM (VALUES {values}) AS n (pdfName) "
+                    "INNER JOIN Regulatory_Untrusted._RegDocs.DTreeCore d ON d.Name LIKE n.pdfName + '%';")
+        with engine2.connect() as conn_:
+            return pd.read_sql(stmt, conn_, params={f"name{i}": name for i, name in enumerate(names)})
+
+    frames = [get_chunk_metadata(pdf_names[i:i + chunk_size]) for i in range(0, len(pdf_names), chunk_size)]
+    if not frames:
+        return {}
+    df = pd.concat(frames).drop_duplicates("pdfName")
+    return df.set_index("pdfName").to_dict("index")
+
+
 def insert_pdf(args):
     buf = StringIO()
+    failed = False
     with redirect_stdout(buf), redirect_stderr(buf):
-        pdf_path, engine_string_, engine2_string_ = args
+        pdf_path, metadata = args
         pdf_path = Path(pdf_path)
-        engine_ = create_engine(engine_string_)
-        engine2_ = create_engine(engine2_string_)
-
-        def get_number_of_pages():
-            with pdf_path.open("rb") as pdf:
-                reader = PyPDF2.PdfFileReader(pdf)
-                if reader.isEncrypted:
-                    reader.decrypt("")
-                total_pages = reader.getNumPages()
-                return total_pages
-
-        def check_if_file_is_in_db_already():
-            with engine_.connect() as conn_:
-                stmt = text("SELECT * FROM pcmr.pdfs WHERE pdfName = :pdf_name;")
-                result_ = conn_.execute(stmt, {"pdf_name": pdf_path.stem})
-                return True if result_.rowcount > 0 else False
-
-        # noinspection SqlResolve
-        def get_pdf_metadata():
-            stmt = text("SELECT ParentID, DataID, CreateDate FROM Regulatory_Untrusted._RegDocs.DTreeCore "
-                        "WHERE Name LIKE :file_name;")
-            with engine2_.connect() as conn_:
-                df = pd.read_sql(stmt, conn_, params={"file_name": pdf_path.stem + "%"})
-            return df.to_dict("records")[0]
+        engine_ = worker_engine
 
-        try:
-            if check_if_file_is_in_db_already():
-                return
+        def get_number_of_pages(pdf_bytes_):
+            reader = PyPDF2.PdfFileReader(BytesIO(pdf_bytes_))
+            if reader.isEncrypted:
+                reader.decrypt("")
+            total_pages = reader.getNumPages()
+            return total_pages
 
-            metadata = get_pdf_metadata()
+        try:
+            # The PDF is read from the share only once, the page count and Tika's XHTML both come from the buffer
+            pdf_bytes = pdf_cache.get(pdf_path).read_bytes()
+            metadata = dict(metadata)
             metadata["pdf_name"] = pdf_path.stem
-            metadata["pdf_size"] = int(pdf_path.stat().st_size / 1024 / 1024 * 100) / 100
-            metadata["total_pages"] = get_number_of_pages()
-            metadata["xmlContent"] = parser.from_file(str(pdf_path), xmlContent=True)["content"]
-
-            csv_data = get_additional_data(pdf_path.stem)
-            metadata["company"] = csv_data["company"]
-            metadata["submitter"] = csv_data["submitter"]
-            metadata["application_id"] = csv_data["application_id"]
+            metadata["pdf_size"] = int(len(pdf_bytes) / 1024 / 1024 * 100) / 100
+            metadata["total_pages"] = get_number_of_pages(pdf_bytes)
+            metadata["xmlContent"] = encode_xml_content(tika_extractor.extract(pdf_bytes))
 
             with engine_.connect() as conn:
                 statement = text("INSERT INTO pdfs (pdfId, pdfName, pdfSize, filingId, date, totalPages, xmlContent,"
@@ -100,26 +698,49 @@ def insert_pdf(args):
         except Exception as e:
             print(f"{pdf_path.stem}: ERROR! {e}")
             traceback.print_tb(e.__traceback__)
+            failed = True
         finally:
-            return buf.getvalue()
+            return failed, buf.getvalue()
 
 
 def insert_pdfs():
-    pdf_files = list(pdf_files_folder.glob("*.pdf"))
-    args = [(pdf, engine_string, engine2_string) for pdf in pdf_files]
-    print(f"Items to process: {len(args)}")
     start_time = time.time()
+    with engine.connect() as conn:
+        existing_pdfs = set(pd.read_sql("SELECT pdfName FROM pdfs;", conn)["pdfName"])
+    pdf_files = [pdf for pdf in pdf_files_folder.glob("*.pdf") if pdf.stem not in existing_pdfs]
+    print(f"Found {len(pdf_files)} new PDFs ({len(existing_pdfs)} PDFs are in the DB already)")
+    if not pdf_files:
+        return
+
+    # Prefetching the metadata of the whole batch instead of querying Regulatory_Untrusted once per PDF
+    pdfs_metadata = get_pdfs_metadata([pdf.stem for pdf in pdf_files])
+    args = []
+    for pdf in pdf_files:
+        if pdf.stem not in pdfs_metadata:
+            print(f"{pdf.stem}: ERROR! not found in Regulatory_Untrusted._RegDocs.DTreeCore")
+            continue
+        try:
+            csv_data = get_additional_data(pdf.stem)
+        except Exception as e:
+            print(f"{pdf.stem}: ERROR! {e}")
+            continue
+        metadata = pdfs_metadata[pdf.stem]
+        metadata["company"] = csv_data["company"]
+        metadata["submitter"] = csv_data["submitter"]
+        metadata["application_id"] = csv_data["application_id"]
+        args.append((pdf, metadata))
+    print(f"Items to process: {len(args)}")
+    tika_extractor.start_servers()
+    pdf_cache.prefetch([arg[0] for arg in args])
 
     # Sequential mode
+    # init_worker(engine_string)
     # for arg in args[:]:
-    #     result = insert_pdf(arg)
+    #     _, result = insert_pdf(arg)
     #     print(result[:-1])
 
     # Multiprocessing mode
-    with Pool() as pool:
-        results = pool.map(insert_pdf, args, chunksize=1)
-    for result in results:
-        print(result, end='', flush=True)
+    run_pool(insert_pdf, args)
 
     duration = round(time.time() - start_time)
     print(
@@ -142,14 +763,15 @@ def insert_pdfs():
 # CAREFUL! DELETES **ALL** THE CSVs AND JPGs, and resets the CORRECT_CSV fields!!!
 # noinspection SqlWithoutWhere
 def delete_csvs_and_images():
+    create_artifacts_table()
     with engine.connect() as conn:
         result = conn.execute("DELETE FROM csvs;")
         print(f"Deleted {result.rowcount} csvs from DB")
         result = conn.execute("UPDATE tables SET csvsExtracted = NULL WHERE csvsExtracted IS NOT NULL;")
         print(f"Reset {result.rowcount} tables (csvsExtracted) from DB")
-        csvs = list(csv_tables_folder.glob("*.csv"))
-        for f in csvs:
-            f.unlink()
+        csvs = [row[0] for row in conn.execute("SELECT path FROM artifacts WHERE kind = 'csv';")]
+        ArtifactStore("csv", csv_tables_folder).delete(csvs)
+        conn.execute("DELETE FROM artifacts WHERE kind = 'csv';")
         print(f"Deleted {len(csvs)} CSV files")
 
         result = conn.execute("UPDATE tables SET correct_csv = NULL WHERE correct_csv IS NOT NULL;")
@@ -157,304 +779,872 @@ def delete_csvs_and_images():
 
         result = conn.execute("UPDATE tables SET imageExtracted = NULL WHERE imageExtracted IS NOT NULL;")
         print(f"Reset {result.rowcount} tables (imageExtracted) from DB")
-        csvs = list(jpg_tables_folder.glob("*.jpg"))
-        for f in csvs:
-            f.unlink()
-        print(f"Deleted {len(csvs)} JPG files")
+        jpgs = [row[0] for row in conn.execute("SELECT path FROM artifacts WHERE kind = 'jpg';")]
+        ArtifactStore("jpg", jpg_tables_folder).delete(jpgs)
+        conn.execute("DELETE FROM artifacts WHERE kind = 'jpg';")
+        print(f"Deleted {len(jpgs)} JPG files")
+
+
+# Returns (width, height) of every page in PDF points, read from the page tree instead of rendering the pages.
+# It matches what ImageMagick reports at its default 72 dpi: the MediaBox (or the CropBox with use_cropbox=True),
+# swapped for pages with a /Rotate of 90 or 270 degrees.
+@lru_cache(maxsize=16)
+def get_page_sizes(pdf_path, use_cropbox=False):
+    with open(pdf_path, "rb") as pdf:
+        reader = PyPDF2.PdfFileReader(pdf)
+        if reader.isEncrypted:
+            reader.decrypt("")
+        sizes = []
+        for page_number in range(reader.getNumPages()):
+            page = reader.getPage(page_number)
+            box = page.cropBox if use_cropbox else page.mediaBox
+            width = int(round(float(box.getWidth())))
+            height = int(round(float(box.getHeight())))
+            if int(page.get("/Rotate", 0)) % 180 == 90:
+                width, height = height, width
+            sizes.append((width, height))
+        return sizes
+
+
+def get_page_size(pdf_path, page):
+    return get_page_sizes(str(pdf_path))[page - 1]
+
+
+stage_conditions = {
+    "coordinates": "t.pdfX1 IS NULL",
+    "csvs": "t.pdfX1 IS NOT NULL AND t.csvsExtracted IS NULL",
+    "images": "t.pdfX1 IS NOT NULL AND t.imageExtracted IS NULL",
+}
+
+
+# Runs a "SELECT ... FROM tables t ... WHERE ..." statement (without the semicolon), limited to table_ids if given
+def read_tables(statement, table_ids=None):
+    params = {}
+    if table_ids is not None:
+        statement += " AND t.tableId IN :table_ids"
+        params["table_ids"] = list(table_ids)
+    statement = text(statement + ";")
+    if table_ids is not None:
+        statement = statement.bindparams(bindparam("table_ids", expanding=True))
+    with engine.connect() as conn:
+        return pd.read_sql(statement, conn, params=params)
+
 
+coordinates_statement = ("UPDATE tables SET pdfWidth = :pdfWidth, pdfHeight = :pdfHeight, pdfX1 = :pdfX1, "
+                         "pdfX2 = :pdfX2, pdfY1 = :pdfY1, pdfY2 = :pdfY2 WHERE tableId = :tableId;")
 
+
+# Returns the parameters of coordinates_statement for the table, or None if its page size could not be read
 def populate_coordinate(table):
     try:
-        with engine.connect() as conn:
-            pdf = pdf_files_folder.joinpath(f"{table['pdfName']}.pdf").resolve()
-            with Image(filename=f"{pdf}[{table['page'] - 1}]") as i:
-                pdf_width = i.width
-                pdf_height = i.height
-
-            x1 = int(table["x1"] * pdf_width / table["pageWidth"])
-            x2 = int(table["x2"] * pdf_width / table["pageWidth"])
-            y1 = int(table["y1"] * pdf_height / table["pageHeight"])
-            y2 = int(table["y2"] * pdf_height / table["pageHeight"])
-
-            query = (f"UPDATE tables SET pdfWidth={pdf_width}, pdfHeight={pdf_height}, pdfX1={x1}," +
-                     f"pdfX2={x2}, pdfY1={y1}, pdfY2={y2} WHERE tableId='{table['tableId']}';")
-            conn.execute(query)
+        pdf = pdf_cache.get(pdf_files_folder.joinpath(f"{table['pdfName']}.pdf"))
+        pdf_width, pdf_height = get_page_size(pdf, table["page"])
+
+        x1 = int(table["x1"] * pdf_width / table["pageWidth"])
+        x2 = int(table["x2"] * pdf_width / table["pageWidth"])
+        y1 = int(table["y1"] * pdf_height / table["pageHeight"])
+        y2 = int(table["y2"] * pdf_height / table["pageHeight"])
+
+        return {"tableId": table["tableId"], "pdfWidth": pdf_width, "pdfHeight": pdf_height, "pdfX1": x1, "pdfX2": x2,
+                "pdfY1": y1, "pdfY2": y2}
     except Exception as e:
         print(f"Error for {table['pdfName']} - page {table['page']}: {e}")
+        return None
 
 
-def populate_coordinates():
+# Returns the tableIds that failed
+def populate_coordinates(table_ids=None):
     start_time = time.time()
-    statement = text("SELECT * FROM tables WHERE pdfX1 IS NULL;")
-    with engine.connect() as conn:
-        df = pd.read_sql(statement, conn)
-    tables = df.to_dict("records")
+    df = read_tables(f"SELECT t.* FROM tables t WHERE {stage_conditions['coordinates']}", table_ids)
+    # Sorted by PDF so that the page sizes of every PDF are read once and then served from get_page_sizes' cache
+    tables = df.sort_values(["pdfName", "page"]).to_dict("records")
     print(f"Populating coordinates on {len(tables)} tables:")
+    pdf_cache.prefetch(list(dict.fromkeys(pdf_files_folder.joinpath(f"{t['pdfName']}.pdf") for t in tables)))
 
-    # for table in tables:
-    #     populate_coordinate(table)
-
-    with Pool() as pool:
-        pool.map(populate_coordinate, tables, chunksize=1)
+    failed = []
+    with BatchedWriter(coordinates_statement) as writer:
+        for table in tables:
+            coordinates = populate_coordinate(table)
+            if coordinates is None:
+                failed.append(table["tableId"])
+            else:
+                writer.add([coordinates])
 
     dur = round(time.time() - start_time)
     print(f"Done {len(tables)} in {dur} seconds ({round(dur / 60, 2)} min or {round(dur / 3600, 2)} hours)")
+    return failed
+
+
+# Estimated peak memory of rendering a page of width x height PDF points with ImageMagick (16 bits per RGBA channel)
+# plus a fixed allowance for the worker process, Ghostscript and the crops
+def estimate_render_memory(width, height, resolution=300):
+    pixels = (width / 72 * resolution) * (height / 72 * resolution)
+    return int(pixels * 8 + 256 * 1024 * 1024)
+
+
+# DPI at which a width x height points rectangle renders to about pixel_budget pixels, within the DPI bounds
+def fit_resolution(width, height, pixel_budget, min_resolution=crop_min_resolution,
+                   max_resolution=crop_max_resolution):
+    square_inches = max(abs(width * height), 1) / 72 / 72
+    return int(max(min_resolution, min(max_resolution, (pixel_budget / square_inches) ** 0.5)))
+
+
+def table_resolution(table):
+    return fit_resolution(table["pdfX2"] - table["pdfX1"], table["pdfY2"] - table["pdfY1"], crop_pixel_budget)
+
+
+# Full page render resolution of the wand renderer for the given tables of one page
+def page_resolution(tables):
+    return fit_resolution(tables[0]["pdfWidth"], tables[0]["pdfHeight"], page_pixel_budget, min_resolution=1,
+                          max_resolution=page_max_resolution)
 
 
+def status_statement(column):
+    return f"UPDATE tables SET {column} = 'done' WHERE tableId = :tableId;"
+
+
+# Marks the tables of the pages that timed out, so that the following runs do not get stuck on them again
+def quarantine_tables(column, pages):
+    table_ids = [table["tableId"] for tables in pages for table in tables]
+    if not table_ids:
+        return
+    with engine.connect() as conn:
+        statement = text(f"UPDATE tables SET {column} = 'quarantined' WHERE tableId = :tableId;")
+        conn.execute(statement, [{"tableId": table_id} for table_id in table_ids])
+    print(f"Quarantined {len(table_ids)} tables ({column}): {', '.join(table_ids)}")
+
+
+def release_quarantined_tables():
+    with engine.connect() as conn:
+        for column in ["csvsExtracted", "imageExtracted"]:
+            result = conn.execute(f"UPDATE tables SET {column} = NULL WHERE {column} = 'quarantined';")
+            print(f"Released {result.rowcount} quarantined tables ({column})")
+
+
+# Saves the table image and its image_levels copies, plus a manifest level (<tableId>.json) with the file and size of
+# each level, so that the apps can show a small version first
+def save_image_pyramid(img, jpg_store, table_id, engine_=None):
+    img.format = "jpg"
+    files = [jpg_store.file(table_id, f"{table_id}.jpg", img.make_blob())]
+    manifest = {"full": {"file": files[0][0]["path"], "width": img.width, "height": img.height}}
+    for level, max_side in image_levels.items():
+        with img.clone() as scaled:
+            scale = max_side / max(scaled.width, scaled.height)
+            if scale < 1:
+                scaled.resize(max(round(scaled.width * scale), 1), max(round(scaled.height * scale), 1))
+            scaled.format = image_levels_format
+            files.append(jpg_store.file(table_id, f"{table_id}.{image_levels_format}", scaled.make_blob(), level))
+            manifest[level] = {"file": files[-1][0]["path"], "width": scaled.width, "height": scaled.height}
+    files.append(jpg_store.file(table_id, f"{table_id}.json", json.dumps(manifest).encode("utf-8"), "manifest"))
+    jpg_store.put(files, engine_)
+
+
+# Renders (or with the pymupdf renderer, clip-renders) the tables of one page with a single page renderer
+# Returns the tables whose images were saved as status_statement("imageExtracted") parameters
 def extract_image(args):
     buf = StringIO()
+    failed = False
+    done = []
     with redirect_stdout(buf), redirect_stderr(buf):
-        table, engine_string_, pdf_files_folder_string, jpg_tables_folder_string = args
+        tables, pdf_files_folder_string, jpg_tables_folder_string, renderer = args
         pdf_files_folder_ = Path(pdf_files_folder_string)
-        jpg_tables_folder_ = Path(jpg_tables_folder_string)
-        engine_ = create_engine(engine_string_)
+        jpg_store = ArtifactStore("jpg", jpg_tables_folder_string)
 
         try:
-            pdf_file_path = pdf_files_folder_.joinpath(f'{table["pdfName"]}.pdf')
-            img_arg_string = f'{pdf_file_path.resolve()}[{table["page"] - 1}]'
-            with Image(filename=img_arg_string, resolution=300) as img:
-                left = round(table["pdfX1"] * img.width / table["pdfWidth"])
-                top = round((table["pdfHeight"] - table["pdfY1"]) * img.height / table["pdfHeight"])
-                right = round(table["pdfX2"] * img.width / table["pdfWidth"])
-                bottom = round((table["pdfHeight"] - table["pdfY2"]) * img.height / table["pdfHeight"])
-                img.crop(left=left, top=top, right=right, bottom=bottom)
-                img.format = "jpg"
-                img.save(filename=jpg_tables_folder_.joinpath(f'{table["tableId"]}.jpg'))
-                with engine_.connect() as conn:
-                    statement = text("UPDATE tables SET imageExtracted = 'done' WHERE tableId = :tableId;")
-                    conn.execute(statement, {"tableId": table["tableId"]})
+            pdf_file_path = pdf_cache.get(pdf_files_folder_.joinpath(f'{tables[0]["pdfName"]}.pdf'))
+            with page_renderers[renderer](pdf_file_path, tables[0]["page"], page_resolution(tables)) as page_renderer:
+                for table in tables:
+                    try:
+                        with page_renderer.crop(table, table_resolution(table)) as crop:
+                            save_image_pyramid(crop, jpg_store, table["tableId"], worker_engine)
+                        done.append({"tableId": table["tableId"]})
+                    except Exception as e:
+                        print(f'Error extracting {table["tableId"]}: {e}')
+                        traceback.print_tb(e.__traceback__)
+                        failed = True
         except Exception as e:
-            print(f'Error extracting {table["tableId"]}: {e}')
+            print(f'Error rendering page {tables[0]["page"]} of {tables[0]["pdfName"]}: {e}')
             traceback.print_tb(e.__traceback__)
+            failed = True
         finally:
-            return buf.getvalue()
+            return failed, buf.getvalue(), done
 
 
-def extract_images():
-    statement = text("SELECT * FROM tables WHERE imageExtracted IS NULL AND pdfX1 IS NOT NULL;")
-    with engine.connect() as conn:
-        df = pd.read_sql(statement, conn)
-        tables = df.to_dict("records")
+def create_args_for_image_extraction(table_ids=None, renderer=image_renderer):
+    df = read_tables(f"SELECT t.* FROM tables t WHERE {stage_conditions['images']}", table_ids)
+
+    pages = [page.to_dict("records") for _, page in df.groupby(["pdfName", "page"])]
+    args = [(tables, str(pdf_files_folder), str(jpg_tables_folder), renderer) for tables in pages]
+    return args
 
-    args = [(table, engine_string, str(pdf_files_folder),
-             str(jpg_tables_folder)) for table in tables]
 
-    print(f"Extracting {len(args)} images:")
+# Memory cost of an extract_image task, see SupervisedPool
+def estimate_image_extraction_memory(arg):
+    tables, _, _, renderer = arg
+    if renderer == "pymupdf":  # Only the largest table of the page is held in memory at once
+        return max(estimate_render_memory(abs(t["pdfX2"] - t["pdfX1"]), abs(t["pdfY2"] - t["pdfY1"]),
+                                          table_resolution(t)) for t in tables)
+    return estimate_render_memory(tables[0]["pdfWidth"], tables[0]["pdfHeight"], page_resolution(tables))
+
+
+# Returns the tableIds that failed
+def extract_images(table_ids=None, renderer=image_renderer):
+    args = create_args_for_image_extraction(table_ids, renderer)
+    total = sum(len(arg[0]) for arg in args)
+
+    print(f"Extracting {total} images from {len(args)} pages:")
+    create_artifacts_table()
+    pdf_cache.prefetch(list(dict.fromkeys(pdf_files_folder.joinpath(f"{arg[0][0]['pdfName']}.pdf") for arg in args)))
     start_time = time.time()
 
     # Sequential mode
-    # results = [ext_funcs.extract_image(arg) for arg in args]
+    # init_worker(engine_string)
+    # results = [extract_image(arg) for arg in args]
 
     # Multiprocessing mode
-    with Pool() as pool:
-        results = pool.map(extract_image, args, chunksize=1)
-
-    for result in results:
-        print(result, end='', flush=True)
+    costs = [estimate_image_extraction_memory(arg) for arg in args]
+    with BatchedWriter(status_statement("imageExtracted")) as writer:
+        failed, timed_out = run_pool(extract_image, args, timeout=extraction_timeout,
+                                     max_tasks_per_child=max_tasks_per_child, costs=costs,
+                                     memory_budget=render_memory_budget, writer=writer)
+    quarantine_tables("imageExtracted", [arg[0] for arg in timed_out])
 
     dur = round(time.time() - start_time)
-    print(f"Done {len(args)} in {dur} seconds ({round(dur / 60, 2)} min or {round(dur / 3600, 2)} hours)")
+    print(f"Done {total} in {dur} seconds ({round(dur / 60, 2)} min or {round(dur / 3600, 2)} hours)")
+    return [table["tableId"] for arg in failed if arg not in timed_out for table in arg[0]]
+
+
+# Content stream operators counted by count_page_operators, delimited like PDF tokens, and what they are erased from
+page_operator_pattern = re.compile(rb"(?<![^\s\]\)>])(Tj|TJ|'|\"|re|l|BI)(?![^\s\[\(/<%])")
+inline_image_data_pattern = re.compile(rb"\bID\s.*?\bEI\b", re.DOTALL)
+string_literal_pattern = re.compile(rb"\((?:\\.|[^\\()])*\)", re.DOTALL)
+
+
+# Counts the text showing, the path (line/rectangle) and the image operators of a fitz page with a byte-level scan of
+# its content streams and those of its Form XObjects. Image XObjects are counted by the page's references to them.
+def count_page_operators(doc, page):
+    counts = {}
+    for xref in [0] + [xobject[0] for xobject in page.get_xobjects()]:
+        stream = inline_image_data_pattern.sub(b" ", (doc.xref_stream(xref) if xref else page.read_contents()) or b"")
+        n = 1
+        while n:  # Innermost strings first, literals may nest balanced parentheses
+            stream, n = string_literal_pattern.subn(b" ", stream)
+        for operator in page_operator_pattern.findall(stream):
+            counts[operator] = counts.get(operator, 0) + 1
+    text_operators = sum(counts.get(operator, 0) for operator in (b"Tj", b"TJ", b"'", b'"'))
+    rule_operators = counts.get(b"re", 0) + counts.get(b"l", 0)
+    image_operators = counts.get(b"BI", 0) + len(page.get_images(full=True))
+    return text_operators, rule_operators, image_operators
+
+
+# Classifies pages of one PDF as "ruled" (text with ruling lines or images, which may be a scan with an OCR layer or
+# ruling drawn as pictures, worth trying lattice as it finds the lines on the rendered page), "text" (text layer only,
+# stream only) or "image" (no text layer, e.g. scans, where neither camelot flavor can succeed)
+def classify_pages(args):
+    buf = StringIO()
+    failed = False
+    with redirect_stdout(buf), redirect_stderr(buf):
+        pdf_name, pages, pdf_files_folder_string = args
+        try:
+            rows = []
+            with fitz.open(str(pdf_cache.get(Path(pdf_files_folder_string).joinpath(f"{pdf_name}.pdf")))) as doc:
+                for page in pages:
+                    text_operators, rule_operators, image_operators = count_page_operators(doc, doc[page - 1])
+                    if text_operators == 0:
+                        page_type = "image"
+                    elif rule_operators >= 4 or image_operators:
+                        page_type = "ruled"
+                    else:
+                        page_type = "text"
+                    rows.append({"pdfName": pdf_name, "page": page, "pageType": page_type,
+                                 "textOperators": text_operators, "ruleOperators": rule_operators})
+            with worker_engine.connect() as conn:
+                statement = text("INSERT IGNORE INTO page_types (pdfName, page, pageType, textOperators, "
+                                 "ruleOperators) VALUES (:pdfName, :page, :pageType, :textOperators, :ruleOperators);")
+                conn.execute(statement, rows)
+            print(f"{pdf_name}: classified {len(rows)} pages")
+        except Exception as e:
+            print(f"{pdf_name}: ERROR classifying pages! {e}")
+            traceback.print_tb(e.__traceback__)
+            failed = True
+        finally:
+            return failed, buf.getvalue()
 
 
-def create_args_for_csv_extraction():
-    statement = text("SELECT * FROM tables WHERE pdfX1 IS NOT NULL AND csvsExtracted IS NULL;")
+def create_page_types_table():
     with engine.connect() as conn:
-        df = pd.read_sql(statement, conn)
-        tables = df.to_dict("records")
+        conn.execute("CREATE TABLE IF NOT EXISTS page_types (pdfName varchar(255) NOT NULL, page int NOT NULL, "
+                     "pageType varchar(255) NOT NULL, textOperators int NOT NULL, ruleOperators int NOT NULL, "
+                     "PRIMARY KEY (pdfName, page));")
+
+
+def create_args_for_page_classification(table_ids=None):
+    statement = ("SELECT DISTINCT t.pdfName, t.page FROM tables t LEFT JOIN page_types pt "
+                 "ON pt.pdfName = t.pdfName AND pt.page = t.page "
+                 f"WHERE {stage_conditions['csvs']} AND pt.pageType IS NULL")
+    df = read_tables(statement, table_ids)
 
-    args = [(table, engine_string, str(pdf_files_folder),
-             str(csv_tables_folder)) for table in tables]
+    args = [(pdf_name, sorted(pages["page"].tolist()), str(pdf_files_folder))
+            for pdf_name, pages in df.groupby("pdfName")]
     return args
 
 
-def extract_csv(args):
-    # noinspection PyTypeChecker
-    def cleanup_df(df):
-        def row_has_content(row):
-            r = re.compile(r"\S")  # Any non-whitespace character
-            for cell in row:
-                if r.search(cell):
-                    return True
-            return False
-
-        def remove_cid(rows_):
-            r = re.compile(r"\(cid:\d+\)")
-            return [[re.sub(r, " ", cell) for cell in row] for row in rows_]
-
-        output = df.values.tolist()
-        output = remove_cid(output)
-        output = [row for row in output if row_has_content(row)]
-        output = pd.DataFrame(output).T.values.tolist()
-        output = [row for row in output if row_has_content(row)]
-        output = pd.DataFrame(output).T
-        return output
+def classify_pending_pages(table_ids=None):
+    create_page_types_table()
+    args = create_args_for_page_classification(table_ids)
+    if not args:
+        return
+    print(f"Classifying {sum(len(arg[1]) for arg in args)} pages in {len(args)} PDFs:")
+    pdf_cache.prefetch([pdf_files_folder.joinpath(f"{arg[0]}.pdf") for arg in args])
+    run_pool(classify_pages, args, timeout=extraction_timeout, max_tasks_per_child=max_tasks_per_child)
+
+
+def create_args_for_csv_extraction(table_ids=None):
+    statement = ("SELECT t.*, pt.pageType FROM tables t LEFT JOIN page_types pt "
+                 f"ON pt.pdfName = t.pdfName AND pt.page = t.page WHERE {stage_conditions['csvs']}")
+    df = read_tables(statement, table_ids)
+
+    pages = [page.to_dict("records") for _, page in df.groupby(["pdfName", "page"])]
+    args = [(tables, str(pdf_files_folder), str(csv_tables_folder)) for tables in pages]
+    return args
+
+
+# Area of the intersection of a camelot table's bbox with a "x1,y1,x2,y2" table area
+def area_overlap(bbox, table_area):
+    ax1, ay1, ax2, ay2 = [float(c) for c in table_area.split(",")]
+    bx1, by1, bx2, by2 = bbox
+    width = min(max(ax1, ax2), max(bx1, bx2)) - max(min(ax1, ax2), min(bx1, bx2))
+    height = min(max(ay1, ay2), max(by1, by2)) - max(min(ay1, ay2), min(by1, by2))
+    return max(width, 0) * max(height, 0)
+
 
+# Replaces the (cid:N) placeholders of unmapped glyphs and drops the rows and columns without any non-whitespace
+# cell (empty or NaN). Non-string cells, like the numbers of a manually added CSV, are kept as they are.
+def cleanup_df(df):
+    cells = (df.fillna("") if df.isna().values.any() else df).to_numpy(dtype=str)
+    cid_cells = np.flatnonzero(np.char.find(cells, "(cid:") >= 0)
+    if cid_cells.size:
+        df = df.copy()
+        for row, column in zip(*np.unravel_index(cid_cells, cells.shape)):  # Only these cells need the regex
+            df.iat[row, column] = cells[row, column] = re.sub(r"\(cid:\d+\)", " ", cells[row, column])
+    has_content = (cells != "") & ~np.char.isspace(cells)
+    df = df.loc[has_content.any(axis=1), has_content.any(axis=0)].reset_index(drop=True)
+    df.columns = range(df.shape[1])
+    return df
+
+
+csv_insert_statement = ("INSERT INTO csvs (csvId, tableId, method, csvHeaders, csvRows, csvColumns, csvText) "
+                        "VALUE (:csvId, :tableId, :method, :csvHeaders, :csvRows, :csvColumns, :csvText);")
+
+
+# Returns the csv_insert_statement parameters of a cleaned up table and its file for csv_store.put
+def save_csv(df, csv_store, table_id, method, csv_id=None):
+    csv_id = csv_id or str(uuid4())
+    csv_rows, csv_columns = df.shape
+    csv_headers = json.dumps(df.iloc[0].tolist())
+    csv_text = df.to_json(None, orient='values')
+    data = df.to_csv(None, index=False, header=False).encode("utf-8-sig")
+    file = csv_store.file(csv_id, f"{csv_id}.csv", data)
+    return {"csvId": csv_id, "tableId": table_id, "method": method, "csvHeaders": csv_headers, "csvRows": csv_rows,
+            "csvColumns": csv_columns, "csvText": csv_text}, file
+
+
+# Extracts the CSVs of all the tables captured on one page. Each camelot flavor is run once with a table area per
+# table and the tables it finds are matched back to the captured tables by their bounding boxes.
+# The CSVs of the page are inserted in the same transaction that marks its tables done, so a crash can not leave
+# CSVs behind that a later run would extract again.
+def extract_csv(args):
     buf = StringIO()
+    failed = False
     with redirect_stdout(buf), redirect_stderr(buf):
-        table, engine_string_, pdf_files_folder_string, csv_tables_folder_string = args
+        tables, pdf_files_folder_string, csv_tables_folder_string = args
         pdf_files_folder_ = Path(pdf_files_folder_string)
-        csv_tables_folder_ = Path(csv_tables_folder_string)
-        engine_ = create_engine(engine_string_)
+        csv_store = ArtifactStore("csv", csv_tables_folder_string)
+        page = tables[0]["page"]
+        records = []
+        files = []
 
-        def save_table(tables_, method_):
+        def save_table(table, tables_, method_):
             if not tables_ or len(tables_) != 1:
                 return print(f"{table['tableId']}: ERROR! found {len(tables_)} tables with {method_}")
-            csv_id = str(uuid4())
-            csv_table = tables_[0]
-            csv_file_name = csv_tables_folder_.joinpath(f"{csv_id}.csv")
-            df = csv_table.df
-            df = cleanup_df(df)
-            csv_rows, csv_columns = df.shape
-            if csv_rows == 0 or csv_columns == 0:
+            df = cleanup_df(tables_[0].df)
+            if df.empty:
                 return
-            csv_headers = json.dumps(df.iloc[0].tolist())
-            csv_text = df.to_json(None, orient='values')
-            df.to_csv(csv_file_name, index=False, header=False, encoding="utf-8-sig")
-
-            with engine_.connect() as conn_:
-                stmt = text(
-                    "INSERT INTO csvs (csvId, tableId, method, csvHeaders, csvRows, csvColumns, csvText) " +
-                    "VALUE (:csvId, :tableId, :method, :csvHeaders, :csvRows, :csvColumns, :csvText);")
-                params = {"csvId": csv_id, "tableId": table["tableId"], "method": method_, "csvHeaders": csv_headers,
-                          "csvRows": csv_rows, "csvColumns": csv_columns, "csvText": csv_text}
-                conn_.execute(stmt, params)
-
-        try:
-            pdf_file_path = pdf_files_folder_.joinpath(f"{table['pdfName']}.pdf")
-            table_areas = [f"{table['pdfX1']},{table['pdfY1']},{table['pdfX2']},{table['pdfY2']}"]
-
-            try:
-                method = "lattice-v"
-                tables = camelot.read_pdf(str(pdf_file_path), table_areas=table_areas, pages=str(table['page']),
-                                          strip_text='\n', line_scale=40, flag_size=True, copy_text=['v'], )
-                save_table(tables, method)
-            except Exception as e:
-                t_id = table['tableId']
-                p = table['page']
-                print(f"Table {t_id} csvs extraction error on page {p} with method {method}: {e}")
-
+            record, file = save_csv(df, csv_store, table["tableId"], method_)
+            records.append(record)
+            files.append(file)
+
+        # Returns {tableId: [camelot tables]} for the given tables. If the call for several areas fails, every
+        # table is retried on its own so that one bad area does not cost the other tables of the page their CSVs.
+        def read_page_tables(tables_, method_, **kwargs):
+            table_areas = [f"{t['pdfX1']},{t['pdfY1']},{t['pdfX2']},{t['pdfY2']}" for t in tables_]
             try:
-                method = "stream"
-                tables = camelot.read_pdf(str(pdf_file_path), table_areas=table_areas, pages=str(table['page']),
-                                          strip_text='\n', flavor="stream", flag_size=True)
-                save_table(tables, method)
-            except Exception as e:
-                t_id = table['tableId']
-                p = table['page']
-                print(f"Table {t_id} csvs extraction error on page {p} with method {method}: {e}")
+                found = camelot.read_pdf(str(pdf_file_path), table_areas=table_areas, pages=str(page), **kwargs)
+            except Exception as e_:
+                if len(tables_) > 1:
+                    results = {}
+                    for t in tables_:
+                        results.update(read_page_tables([t], method_, **kwargs))
+                    return results
+                print(f"Table {tables_[0]['tableId']} csvs extraction error on page {page} with method {method_}: {e_}")
+                return {}
+
+            results = {t["tableId"]: [] for t in tables_}
+            for csv_table in found:
+                overlaps = [area_overlap(csv_table._bbox, area) for area in table_areas]
+                best = int(np.argmax(overlaps))
+                if overlaps[best] > 0:
+                    results[tables_[best]["tableId"]].append(csv_table)
+            return results
 
-            with engine_.connect() as conn:
-                statement = text("UPDATE tables SET csvsExtracted = 'done' WHERE tableId = :tableId;")
-                conn.execute(statement, {"tableId": table['tableId']})
+        try:
+            pdf_file_path = pdf_cache.get(pdf_files_folder_.joinpath(f"{tables[0]['pdfName']}.pdf"))
+
+            methods = {
+                "lattice-v": dict(strip_text='\n', line_scale=40, flag_size=True, copy_text=['v']),
+                "stream": dict(strip_text='\n', flavor="stream", flag_size=True),
+            }
+            page_type = tables[0].get("pageType")
+            if page_type == "image":
+                print(f"Page {page} of {tables[0]['pdfName']} has no text layer, skipping camelot")
+                methods = {}
+            elif page_type == "text":
+                del methods["lattice-v"]
+            for method, kwargs in methods.items():
+                found_tables = read_page_tables(tables, method, **kwargs)
+                for table in tables:
+                    if table["tableId"] not in found_tables:
+                        continue
+                    try:
+                        save_table(table, found_tables[table["tableId"]], method)
+                    except Exception as e:
+                        t_id = table['tableId']
+                        print(f"Table {t_id} csvs extraction error on page {page} with method {method}: {e}")
+
+            csv_store.put(files, worker_engine)
+            with worker_engine.begin() as conn:  # MySQLdb sends the executemany INSERTs as multi-row statements
+                if records:
+                    conn.execute(text(csv_insert_statement), records)
+                conn.execute(text(status_statement("csvsExtracted")), [{"tableId": t["tableId"]} for t in tables])
         except Exception as e:
-            print(f"Table {table['tableId']} csvs extraction error on page {table['page']}: {e}")
+            print(f"Page {page} of {tables[0]['pdfName']} csvs extraction error: {e}")
             traceback.print_tb(e.__traceback__)
+            failed = True
         finally:
-            return buf.getvalue()
-
+            return failed, buf.getvalue()
 
-def extract_csvs():
-    statement = text("SELECT * FROM tables WHERE pdfX1 IS NOT NULL AND csvsExtracted IS NULL;")
-    with engine.connect() as conn:
-        df = pd.read_sql(statement, conn)
-        tables = df.to_dict("records")
 
-    args = [(table, engine_string, str(pdf_files_folder),
-             str(csv_tables_folder)) for table in tables]
+# Returns the tableIds that failed
+def extract_csvs(table_ids=None):
+    classify_pending_pages(table_ids)
+    create_artifacts_table()
+    args = create_args_for_csv_extraction(table_ids)
 
-    print(f"Extracting CSVs for {len(args)} tables:")
+    print(f"Extracting CSVs for {sum(len(arg[0]) for arg in args)} tables on {len(args)} pages:")
+    pdf_cache.prefetch(list(dict.fromkeys(pdf_files_folder.joinpath(f"{arg[0][0]['pdfName']}.pdf") for arg in args)))
     start_time = time.time()
 
     # Sequential mode
+    # init_worker(engine_string)
     # for arg in args:
-    #     print(extract_csv(arg))
+    #     print(extract_csv(arg)[1])
 
     # Multiprocessing mode
-    with Pool() as pool:
-        results = pool.map(extract_csv, args, chunksize=1)
-    for result in results:
-        print(result, end='', flush=True)
+    failed, timed_out = run_pool(extract_csv, args, timeout=extraction_timeout,
+                                 max_tasks_per_child=max_tasks_per_child)
+    quarantine_tables("csvsExtracted", [arg[0] for arg in timed_out])
 
     dur = round(time.time() - start_time)
-    print(f"Done {len(args)} in {dur} seconds ({round(dur / 60, 2)} min or {round(dur / 3600, 2)} hours)")
+    print(f"Done {len(args)} pages in {dur} seconds ({round(dur / 60, 2)} min or {round(dur / 3600, 2)} hours)")
+    return [table["tableId"] for arg in failed if arg not in timed_out for table in arg[0]]
+
+
+#############################################################################
+# Pipeline, so that every PDF goes through all the stages as soon as it can
+#############################################################################
+
+
+# Pool task of run_pipeline, populates the coordinates of the given tables (of one PDF) in a worker, so that the
+# scheduler does not wait for the PDF to be copied from the share. Returns the coordinates_statement parameters.
+def populate_pdf_coordinates(tables):
+    buf = StringIO()
+    with redirect_stdout(buf), redirect_stderr(buf):
+        rows = [coordinates for coordinates in map(populate_coordinate, tables) if coordinates is not None]
+    return len(rows) < len(tables), buf.getvalue(), rows
+
+
+pipeline_tasks = {"coordinates": populate_pdf_coordinates, "classify": classify_pages, "csvs": extract_csv,
+                  "images": extract_image}
+
+
+# Pool function of run_pipeline, arg is a (task name, task arg) tuple
+def run_pipeline_task(arg):
+    task, task_arg = arg
+    return pipeline_tasks[task](task_arg)
+
+
+# Runs the coordinates, CSVs and images stages PDF by PDF in one SupervisedPool, instead of three sweeps over all the
+# tables with a pool barrier after each. A PDF's missing coordinates are populated by a pool task, then its image
+# tasks are queued right away and its CSV tasks as soon as its pages are classified (CSVs and images only depend on
+# the coordinates, so they run side by side). A new PDF is only taken up while fewer than max_pending tasks are queued
+# or running, so the DB reads stay just ahead of the workers. The coordinates are written once per PDF, before its
+# pages are classified, and the image done flags in batches.
+# Returns the tableIds that failed, per stage.
+def run_pipeline(table_ids=None, renderer=image_renderer, max_pending=None, progress_interval=10):
+    conditions = " OR ".join(f"({condition})" for condition in stage_conditions.values())
+    df = read_tables(f"SELECT t.* FROM tables t WHERE ({conditions})", table_ids)
+    pdfs = deque(tables.to_dict("records") for _, tables in df.groupby("pdfName"))
+    failed = {"coordinates": [], "csvs": [], "images": []}
+    done = {"csvs": 0, "images": 0}
+    tasks = {}
+    keys = count()
+    images_writer = BatchedWriter(status_statement("imageExtracted"))
+    coordinates_writer = BatchedWriter(coordinates_statement)
+
+    print(f"Processing {len(df)} tables in {len(pdfs)} PDFs:")
+    create_page_types_table()
+    create_artifacts_table()
+    pdf_cache.prefetch([pdf_files_folder.joinpath(f"{tables[0]['pdfName']}.pdf") for tables in pdfs])
+    start_time = time.time()
+    last_progress = start_time
+
+    try:
+        with SupervisedPool(run_pipeline_task, timeout=extraction_timeout, max_tasks_per_child=max_tasks_per_child,
+                            initializer=init_worker, initargs=(engine_string,),
+                            memory_budget=render_memory_budget) as pool:
+            max_pending = max_pending or 2 * pool.processes
+
+            def submit(task, arg, context=None, cost=0):
+                key = next(keys)
+                tasks[key] = (task, arg, context)
+                pool.submit(key, (task, arg), cost)
+
+            def submit_csvs(ids):
+                for arg_ in create_args_for_csv_extraction(ids):
+                    submit("csvs", arg_)
+
+            # Queues the CSV and image work of the tables of one PDF that have their coordinates
+            def submit_extraction(tables_):
+                csv_ids = [t["tableId"] for t in tables_ if pd.isna(t["csvsExtracted"])]
+                if csv_ids:
+                    classify_args = create_args_for_page_classification(csv_ids)
+                    if classify_args:
+                        submit("classify", classify_args[0], csv_ids)
+                    else:
+                        submit_csvs(csv_ids)
+                pages = {}
+                for t in tables_:
+                    if pd.isna(t["imageExtracted"]):
+                        pages.setdefault(t["page"], []).append(t)
+                for page in sorted(pages):
+                    arg_ = (pages[page], str(pdf_files_folder), str(jpg_tables_folder), renderer)
+                    submit("images", arg_, cost=estimate_image_extraction_memory(arg_))
+
+            while pdfs or pool.unfinished():
+                while pdfs and pool.unfinished() < max_pending:
+                    tables = pdfs.popleft()
+                    pending = [table for table in tables if pd.isna(table["pdfX1"])]
+                    if pending:
+                        submit("coordinates", pending, tables)
+                    else:
+                        submit_extraction(tables)
+
+                for key, (failed_, output, *rows), timed_out in pool.poll():
+                    task, arg, context = tasks.pop(key)
+                    print(output, end='', flush=True)
+                    if task == "coordinates":
+                        coordinates = {row["tableId"]: row for row in rows[0]} if rows else {}
+                        coordinates_writer.add(list(coordinates.values()))
+                        coordinates_writer.flush()
+                        for table in arg:
+                            if table["tableId"] in coordinates:
+                                table.update(coordinates[table["tableId"]])
+                            else:
+                                failed["coordinates"].append(table["tableId"])
+                        submit_extraction([table for table in context if not pd.isna(table["pdfX1"])])
+                        continue
+                    if task == "classify":
+                        submit_csvs(context)  # Pages that could not be classified are extracted with every method
+                        continue
+                    if rows:
+                        images_writer.add(rows[0])
+                    done[task] += len(arg[0])
+                    if timed_out:
+                        quarantine_tables({"csvs": "csvsExtracted", "images": "imageExtracted"}[task], [arg[0]])
+                    elif failed_:
+                        failed[task].extend(table["tableId"] for table in arg[0])
+
+                if time.time() - last_progress >= progress_interval:
+                    last_progress = time.time()
+                    print(f"Progress: {len(pdfs)} PDFs left, {pool.unfinished()} tasks queued or running, "
+                          f"{done['csvs']} CSV and {done['images']} image tables done, "
+                          f"{sum(len(ids) for ids in failed.values())} failed", flush=True)
+    finally:
+        images_writer.flush()
+
+    dur = round(time.time() - start_time)
+    print(f"Done {len(df)} in {dur} seconds ({round(dur / 60, 2)} min or {round(dur / 3600, 2)} hours)")
+    return failed
+
+
+#############################################################################
+# Job queue, so that several machines can drain the same stage concurrently
+#############################################################################
+
+
+lease_owner = f"{socket.gethostname()}:{os.getpid()}"
+stage_functions = {"coordinates": populate_coordinates, "csvs": extract_csvs, "images": extract_images}
+
+
+def enqueue_jobs(stage):
+    with engine.connect() as conn:
+        conn.execute("CREATE TABLE IF NOT EXISTS jobs (stage varchar(32) NOT NULL, tableId varchar(36) NOT NULL, "
+                     "leaseOwner varchar(255) DEFAULT NULL, leaseExpires datetime DEFAULT NULL, "
+                     "attempts int NOT NULL DEFAULT 0, PRIMARY KEY (stage, tableId), "
+                     "KEY lease_idx (stage, leaseExpires));")
+        conn.execute("DELETE j FROM jobs j LEFT JOIN tables t ON t.tableId = j.tableId WHERE t.tableId IS NULL;")
+        statement = text("INSERT IGNORE INTO jobs (stage, tableId) "
+                         f"SELECT :stage, t.tableId FROM tables t WHERE {stage_conditions[stage]};")
+        result = conn.execute(statement, {"stage": stage})
+    print(f"Queued {result.rowcount} new {stage} jobs")
+
+
+# Leases the jobs of up to limit pages that nobody holds or whose lease expired. Whole pages are claimed, so that a
+# page is never split across batches or machines: the pages are picked first, then every claimable job of them is
+# locked. A page of which another machine locked some jobs in the meantime is left to that machine.
+def claim_jobs(stage, limit, lease_seconds, max_attempts=3):
+    claimable = ("j.stage = :stage AND j.attempts < :max_attempts "
+                 "AND (j.leaseExpires IS NULL OR j.leaseExpires < NOW())")
+    jobs = f"FROM jobs j INNER JOIN tables t ON t.tableId = j.tableId WHERE {claimable}"
+    params = {"stage": stage, "max_attempts": max_attempts, "limit": limit}
+    while True:
+        with engine.begin() as conn:
+            statement = text(f"SELECT DISTINCT t.pdfName, t.page {jobs} ORDER BY t.pdfName, t.page LIMIT :limit;")
+            pages = {tuple(row) for row in conn.execute(statement, params)}
+            if not pages:
+                return []
+            params["pdfs"] = sorted({pdf for pdf, _ in pages})
+            statement = text(f"SELECT t.pdfName, t.page, COUNT(*) {jobs} AND t.pdfName IN :pdfs "
+                             "GROUP BY t.pdfName, t.page;")
+            statement = statement.bindparams(bindparam("pdfs", expanding=True))
+            counts = {(pdf, page): n for pdf, page, n in conn.execute(statement, params)}
+            statement = text(f"SELECT j.tableId, t.pdfName, t.page {jobs} AND t.pdfName IN :pdfs "
+                             "FOR UPDATE OF j SKIP LOCKED;")
+            statement = statement.bindparams(bindparam("pdfs", expanding=True))
+            locked = {}
+            for table_id, pdf, page in conn.execute(statement, params):
+                locked.setdefault((pdf, page), []).append(table_id)
+            table_ids = [table_id for page in sorted(pages) if len(locked.get(page, [])) >= counts.get(page, 0)
+                         for table_id in locked.get(page, [])]
+            if table_ids:
+                statement = text("UPDATE jobs SET leaseOwner = :owner, leaseExpires = NOW() + INTERVAL :lease SECOND, "
+                                 "attempts = attempts + 1 WHERE stage = :stage AND tableId = :tableId;")
+                conn.execute(statement, [{"owner": lease_owner, "lease": lease_seconds, "stage": stage, "tableId": t}
+                                         for t in table_ids])
+                return table_ids
+        time.sleep(1)  # Every picked page is being claimed by another machine, pick again once it leased them
+
+
+def renew_leases(stage, lease_seconds, stop):
+    while not stop.wait(lease_seconds / 3):
+        with engine.connect() as conn:
+            statement = text("UPDATE jobs SET leaseExpires = NOW() + INTERVAL :lease SECOND "
+                             "WHERE stage = :stage AND leaseOwner = :owner;")
+            conn.execute(statement, {"lease": lease_seconds, "stage": stage, "owner": lease_owner})
+
+
+# Succeeded jobs are removed, failed ones are released to be retried (up to claim_jobs' max_attempts)
+def finish_jobs(stage, table_ids, failed_ids):
+    with engine.connect() as conn:
+        done = [{"stage": stage, "tableId": t, "owner": lease_owner} for t in table_ids if t not in failed_ids]
+        if done:
+            conn.execute(text("DELETE FROM jobs WHERE stage = :stage AND tableId = :tableId AND leaseOwner = :owner;"),
+                         done)
+        failed = [{"stage": stage, "tableId": t, "owner": lease_owner} for t in failed_ids]
+        if failed:
+            conn.execute(text("UPDATE jobs SET leaseOwner = NULL, leaseExpires = NULL "
+                              "WHERE stage = :stage AND tableId = :tableId AND leaseOwner = :owner;"), failed)
+
+
+# Drains the queue of a stage ("coordinates", "csvs" or "images") batch by batch of batch_size pages. Can run on any
+# number of machines at the same time, the leases of a crashed machine expire after lease_seconds and its jobs are
+# picked up again.
+def run_queued_stage(stage, batch_size=200, lease_seconds=1800):
+    enqueue_jobs(stage)
+    while True:
+        table_ids = claim_jobs(stage, batch_size, lease_seconds)
+        if not table_ids:
+            break
+        print(f"Claimed {len(table_ids)} {stage} jobs as {lease_owner}")
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=renew_leases, args=(stage, lease_seconds, stop), daemon=True)
+        heartbeat.start()
+        try:
+            failed_ids = set(stage_functions[stage](table_ids))
+        finally:
+            stop.set()
+            heartbeat.join()
+        finish_jobs(stage, table_ids, failed_ids)
+    print(f"No {stage} jobs left to claim")
 
 
 def add_csv_manually(table_id, csv_id, csv_path):
     if not Path(csv_path).exists():
         return print(f"{table_id} does not exist!")
-    csv_file_name = csv_tables_folder.joinpath(f"{csv_id}.csv")
     df = pd.read_csv(csv_path, header=None)
+    df = cleanup_df(df)
+    if df.empty:
+        return print(f"{csv_path} has no content, nothing inserted for {table_id}")
     df = df.replace({np.nan: None})
-    csv_rows, csv_columns = df.shape
-    csv_headers = json.dumps(df.iloc[0].tolist())
-    csv_text = df.to_json(None, orient='values')
-    df.to_csv(csv_file_name, index=False, header=False, encoding="utf-8-sig")
+    create_artifacts_table()
+    csv_store = ArtifactStore("csv", csv_tables_folder)
+    params, file = save_csv(df, csv_store, table_id, "manual", csv_id)
+    csv_store.put([file])
 
     with engine.connect() as conn:
-        stmt = text(
-            "INSERT INTO csvs (csvId, tableId, method, csvHeaders, csvRows, csvColumns, csvText) " +
-            "VALUE (:csvId, :tableId, :method, :csvHeaders, :csvRows, :csvColumns, :csvText);")
-        params = {"csvId": csv_id, "tableId": table_id, "method": "manual", "csvHeaders": csv_headers,
-                  "csvRows": csv_rows, "csvColumns": csv_columns, "csvText": csv_text}
-        conn.execute(stmt, params)
+        conn.execute(text(csv_insert_statement), params)
     print(f"Inserted CSV ID {csv_id} for table {table_id}")
 
 
+# Imports the manually fixed CSVs of a folder (named by the csvId they correct, like manual_csv) as "manual" CSVs of
+# the same tables, in one transaction. Tables that already have a manual CSV are skipped, so it can be re-run.
+def import_manual_csvs(folder=manual_csvs_folder, encoding="cp1252"):
+    files = {f.stem: f for f in Path(folder).glob("*.csv")}
+    if not files:
+        return print(f"No CSVs in {folder}")
+    statement = text("SELECT c.csvId, c.tableId FROM csvs c WHERE c.csvId IN :csv_ids AND NOT EXISTS "
+                     "(SELECT 1 FROM csvs m WHERE m.tableId = c.tableId AND m.method = 'manual');")
+    statement = statement.bindparams(bindparam("csv_ids", expanding=True))
+    with engine.connect() as conn:
+        rows = conn.execute(statement, {"csv_ids": list(files)}).fetchall()
+
+    create_artifacts_table()
+    csv_store = ArtifactStore("csv", csv_tables_folder)
+    records = []
+    csv_files = []
+    for csv_id, table_id in rows:
+        try:
+            df = pd.read_csv(files[csv_id], header=None, encoding=encoding)
+        except Exception as e:
+            print(f"ERROR! {csv_id}.csv: {str(e).strip()}")
+            continue
+        df = cleanup_df(df)
+        if df.empty:
+            continue
+        record, file = save_csv(df.replace({np.nan: None}), csv_store, table_id, "manual")
+        records.append(record)
+        csv_files.append(file)
+
+    for i in range(0, len(csv_files), write_batch_size):
+        csv_store.put(csv_files[i:i + write_batch_size])
+    with engine.begin() as conn:
+        for i in range(0, len(records), write_batch_size):
+            conn.execute(text(csv_insert_statement), records[i:i + write_batch_size])
+    print(f"Imported {len(records)} manual CSVs, {len(files) - len(rows)} of the {len(files)} files were skipped "
+          f"(unknown csvId or already imported)")
+
+
+# Removes the files of the CSVs and tables that are not in the DB anymore, as listed by the artifacts index. Rows of
+# files that were never written (a worker killed between indexing and writing) are dropped the same way.
 def delete_unreferenced_csvs_and_jpgs():
     print(f"Starting the cleanup of unreferenced CSVs and JPGs...")
-    stmt1 = "SELECT csvId FROM csvs;"
-    stmt2 = "SELECT tableId FROM tables;"
+    statement = ("SELECT a.kind, a.path FROM artifacts a "
+                 "LEFT JOIN csvs c ON a.kind = 'csv' AND c.csvId = a.ownerId "
+                 "LEFT JOIN tables t ON a.kind = 'jpg' AND t.tableId = a.ownerId "
+                 "WHERE c.csvId IS NULL AND t.tableId IS NULL;")
+    create_artifacts_table()
     with engine.connect() as conn:
-        df1 = pd.read_sql(stmt1, conn)
-        df2 = pd.read_sql(stmt2, conn)
-    csv_ids = set(df1["csvId"].tolist())
-    table_ids = set(df2["tableId"].tolist())
-
-    csvs = csv_tables_folder.glob("*.csv")
-    jpgs = jpg_tables_folder.glob("*.jpg")
-
-    counter1 = 0
-    for csv in csvs:
-        if csv.stem not in csv_ids:
-            print(f"Removing CSV {csv}")
-            counter1 += 1
-            csv.unlink()
-    counter2 = 0
-    for jpg in jpgs:
-        if jpg.stem not in table_ids:
-            print(f"Removing JPG {jpg}")
-            counter2 += 1
-            jpg.unlink()
-
-    print(f"Removed {counter1} unreferenced CSVs and {counter2} unreferenced JPGs")
+        df = pd.read_sql(statement, conn)
+
+    stores = {"csv": ArtifactStore("csv", csv_tables_folder), "jpg": ArtifactStore("jpg", jpg_tables_folder)}
+    with BatchedWriter("DELETE FROM artifacts WHERE kind = :kind AND path = :path;") as writer:
+        for kind, paths in df.groupby("kind")["path"]:
+            stores[kind].delete(paths)
+            writer.add([{"kind": kind, "path": path} for path in paths])
+
+    counts = df["kind"].value_counts()
+    print(f"Removed {counts.get('csv', 0)} unreferenced CSV files and {counts.get('jpg', 0)} unreferenced JPG files")
+
+
+# Moves the CSVs and JPGs written before the artifact store (<csvId>.csv, <tableId>.jpg, thumb/<tableId>.jpg, ...)
+# into their shards and indexes them. Only needs to run once, it is the last time the flat folders are listed.
+def migrate_artifacts():
+    create_artifacts_table()
+    folders = {"csv": (csv_tables_folder, [None]), "jpg": (jpg_tables_folder, [None, *image_levels, "manifest"])}
+    for kind, (folder, levels) in folders.items():
+        store = ArtifactStore(kind, folder)
+        moved = 0
+        for level in levels:
+            files = list(folder.joinpath(level or "").glob("*.*"))
+            for i in range(0, len(files), write_batch_size):
+                batch = files[i:i + write_batch_size]
+                rows = [{"path": store.relative_path(f.stem, f.name, level), "kind": kind, "ownerId": f.stem,
+                         "sha256": file_sha256(str(f)), "size": f.stat().st_size} for f in batch]
+                with engine.connect() as conn:
+                    conn.execute(text(artifacts_statement), rows)
+                for f, row in zip(batch, rows):
+                    f.replace(store.target(row["path"]))  # A rename on the share, the data is not copied
+                moved += len(batch)
+        print(f"Moved {moved} {kind} files into the artifact store")
 
 
 def populate_projects():
-    df = pd.read_csv(pdfs_and_projects_file, encoding="cp1252", header=0)
     check_query = "SELECT * FROM projects WHERE application_id = %s;"
     stmt = "INSERT INTO projects (application_title, application_title_short, application_id) VALUES (%s,%s,%s);"
 
-    items = set()
+    projects = load_additional_data()["projects"]
     with engine.connect() as conn:
-        for row in df.itertuples():
-            application_id = int(re.search(r"\d+$", row.ApplicationLink).group())
-            if application_id in items:
-                continue
-            items.add(application_id)
+        for application_id, (application_title, application_title_short) in projects.items():
             results = conn.execute(check_query, (application_id,))
             if results.rowcount != 0:
                 continue
-            conn.execute(stmt, (row.ApplicationTitle, row.ApplicationTitleShort, application_id))
+            conn.execute(stmt, (application_title, application_title_short, application_id))
     print("Added all projects")
 
 
-def get_additional_data(pdf_name):
+additional_data = None
+
+
+# Parses pdfs_table.csv once per process into pdfName and application_id indexes. The parsed result is pickled
+# next to the CSV and reused for as long as the CSV's modification time stays the same.
+def load_additional_data():
+    global additional_data
+    if additional_data is not None:
+        return additional_data
+
+    mtime = pdfs_and_projects_file.stat().st_mtime_ns
+    if pdfs_and_projects_cache.exists():
+        try:
+            with pdfs_and_projects_cache.open("rb") as f:
+                cache = pickle.load(f)
+            if cache["mtime"] == mtime:
+                additional_data = cache
+                return additional_data
+        except Exception as e:
+            print(f"Ignoring unreadable {pdfs_and_projects_cache}: {e}")
+
     df = pd.read_csv(pdfs_and_projects_file, encoding="cp1252", header=0)
+    pdfs = {}
+    projects = {}
     for row in df.itertuples():
-        if row.pdfName == pdf_name:
-            application_id = int(re.search(r"\d+$", row.ApplicationLink).group())
-            return {"submitter": row.pdfSubmitter, "application_id": application_id, "company": row.pdfCompany}
-    raise Exception(f"{pdf_name} is not found in the {pdfs_and_projects_file}")
+        application_id = int(re.search(r"\d+$", row.ApplicationLink).group())
+        if row.pdfName not in pdfs:
+            pdfs[row.pdfName] = {"submitter": row.pdfSubmitter, "application_id": application_id,
+                                 "company": row.pdfCompany}
+        if application_id not in projects:
+            projects[application_id] = (row.ApplicationTitle, row.ApplicationTitleShort)
+
+    additional_data = {"mtime": mtime, "pdfs": pdfs, "projects": projects}
+    with pdfs_and_projects_cache.open("wb") as f:
+        pickle.dump(additional_data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return additional_data
+
+
+def get_additional_data(pdf_name):
+    pdfs = load_additional_data()["pdfs"]
+    if pdf_name not in pdfs:
+        raise Exception(f"{pdf_name} is not found in the {pdfs_and_projects_file}")
+    return pdfs[pdf_name]
 
 
 if __name__ == "__main__":
@@ -464,9 +1654,12 @@ if __name__ == "__main__":
     # delete_csvs_and_images()
     # add_csv_manually("c6a472e2-8b94-4f9c-ab4f-2f61ec743a11", "cd9113d6-4870-414e-a86d-c7ee40611c1e",
     #                  r"B-14R Appendix MPLA-SAPL IR 43 b) - TERA Post Construction (A1A3A2)_page.97.csv")
+    # import_manual_csvs()
+    # migrate_artifacts()
 
-    populate_coordinates()
-    extract_csvs()
-    extract_images()
+    # populate_coordinates()
+    # extract_csvs()
+    # extract_images()
+    run_pipeline()
     delete_unreferenced_csvs_and_jpgs()
     pass
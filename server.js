@@ -18,11 +18,31 @@ const csvPath = "\\\\luxor\\data\\board\\Dev\\PCMR\\csv_tables";
   }),
 );
 
+// CSVs and JPGs are sharded by the first two characters of their id (see ArtifactStore in processing.py), so
+// /jpg/<tableId>.jpg is served from <shard>/<tableId>.jpg and /jpg/thumb/<tableId>.jpg from thumb/<shard>/<tableId>.jpg.
+// Anything not found there falls through to the path as requested.
+const shardedStatic = (root) => {
+  const serve = express.static(root);
+  return (req, res, next) => {
+    const match = req.url.match(/^\/(?:([\w-]+)\/)?(([\w-]{2})[\w-]*\.\w+)$/);
+    if (!match) return next();
+    const [, level, name, shard] = match;
+    const url = req.url;
+    req.url = level ? `/${level}/${shard}/${name}` : `/${shard}/${name}`;
+    serve(req, res, () => {
+      req.url = url;
+      next();
+    });
+  };
+};
+
 const app = express();
 app.options("*", cors());
 app.use(cors());
 app.use("/pdf", express.static(pdfPath));
+app.use("/jpg", shardedStatic(jpgPath));
 app.use("/jpg", express.static(jpgPath));
+app.use("/csv", shardedStatic(csvPath));
 app.use("/csv", express.static(csvPath));
 
 // LOGGING